@@ -1,10 +1,11 @@
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, Response
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import json
 import random
 import math
 import time
 import threading
+from array import array
 from datetime import datetime
 
 app = Flask(__name__)
@@ -24,6 +25,23 @@ PROJECTILE_SIZE = 6
 PROJECTILE_SPEED_MIN = 80
 PROJECTILE_SPEED_MAX = 150
 
+# Lag Compensation Constants
+MAX_REWIND_MS = 200  # Never judge a player against state older than this
+MAX_REWIND_TICKS = int(MAX_REWIND_MS / 1000 * FPS)
+HISTORY_TICKS = MAX_REWIND_TICKS + 4  # Ring buffer size (a little headroom)
+MAX_LASERS = 15  # Matches the cap in GameLevel.generate_level
+MAX_HISTORY_PROJECTILES = 64  # Projectiles beyond this are not recorded
+
+# Tick Budget Constants
+TICK_BUDGET = 1 / FPS  # ~16.6 ms per tick
+TICK_LOAD_SMOOTHING = 0.1  # EWMA weight of the newest tick time
+DEGRADE_LOAD = 0.9  # Shed work when smoothed tick time exceeds this share of the budget
+RESTORE_LOAD = 0.5  # Restore quality when it falls below this share
+DEGRADE_AFTER_TICKS = 30  # Sustained pressure (~0.5 s) needed before each step down
+RESTORE_AFTER_TICKS = 180  # Sustained calm (~3 s) needed before each step back up
+# Work is shed in this order and restored in reverse
+DEGRADATION_STEPS = ['snapshot_rate', 'trails', 'spectators', 'admission']
+
 # Player Colors (RGB values)
 PLAYER_COLORS = [
     [255, 0, 0],    # Red
@@ -222,11 +240,24 @@ class LaserLine:
             'is_fast': getattr(self, 'is_fast', False)  # Send fast laser info to client
         }
     
-    def check_collision(self, player_pos, player_size):
-        """Check if player collides with this laser line"""
+    def check_collision(self, player_pos, player_size, rotation_angle=None):
+        """Check if player collides with this laser line
+
+        If rotation_angle is given, the laser is checked at that angle instead
+        of its current one (used for lag-compensated collision).
+        """
         px, py = player_pos
-        x1, y1 = self.start_pos
-        x2, y2 = self.end_pos
+        if rotation_angle is None or not self.is_rotating:
+            x1, y1 = self.start_pos
+            x2, y2 = self.end_pos
+        else:
+            total_angle = self.original_angle + rotation_angle
+            half_length = self.original_length / 2
+            cx, cy = self.rotation_center
+            x1 = cx - half_length * math.cos(total_angle)
+            y1 = cy - half_length * math.sin(total_angle)
+            x2 = cx + half_length * math.cos(total_angle)
+            y2 = cy + half_length * math.sin(total_angle)
         
         # Distance from point to line
         A = py - y1
@@ -265,6 +296,7 @@ class Player:
         self.trail = []
         self.trail_max_length = 20
         self.last_update = time.time()
+        self.view_lag = 0  # Ticks between the server and what this client last saw
     
     def update_position(self, new_pos):
         if self.alive and not self.finished:
@@ -281,15 +313,17 @@ class Player:
         self.finish_time = None
         self.trail = []
     
-    def to_dict(self):
-        return {
+    def to_dict(self, include_trail=True):
+        data = {
             'id': self.id,
             'pos': self.pos,
             'color': self.color,
             'alive': self.alive,
-            'finished': self.finished,
-            'trail': self.trail[-10:]  # Send only last 10 trail points
+            'finished': self.finished
         }
+        if include_trail:
+            data['trail'] = self.trail[-10:]  # Send only last 10 trail points
+        return data
 
 class GameLevel:
     def __init__(self, level_number):
@@ -506,6 +540,161 @@ class GameLevel:
             'projectiles': [projectile.to_dict() for projectile in self.projectiles if projectile.alive]
         }
 
+class ObstacleHistory:
+    """Fixed-size ring buffer of recent per-tick obstacle states.
+
+    Each slot stores only what changes between ticks: the rotation angle of
+    every laser and the position of every live projectile. All storage is
+    preallocated, so recording a tick does not allocate.
+    """
+    def __init__(self, size=HISTORY_TICKS):
+        self.size = size
+        self.laser_angles = array('d', [0.0] * (size * MAX_LASERS))
+        self.projectile_pos = array('d', [0.0] * (size * MAX_HISTORY_PROJECTILES * 2))
+        self.projectile_counts = array('i', [0] * size)
+        self.ticks = array('q', [-1] * size)
+        self.newest_tick = -1
+        self.oldest_tick = 0
+    
+    def reset(self, tick):
+        """Forget recorded states (e.g. on level change); history restarts at tick"""
+        self.newest_tick = tick - 1
+        self.oldest_tick = tick
+    
+    def record(self, tick, level):
+        slot = tick % self.size
+        
+        base = slot * MAX_LASERS
+        for i, laser in enumerate(level.laser_lines):
+            self.laser_angles[base + i] = laser.rotation_angle
+        
+        base = slot * MAX_HISTORY_PROJECTILES * 2
+        count = 0
+        for projectile in level.projectiles:
+            if count >= MAX_HISTORY_PROJECTILES:
+                break
+            if projectile.alive:
+                self.projectile_pos[base + count * 2] = projectile.pos[0]
+                self.projectile_pos[base + count * 2 + 1] = projectile.pos[1]
+                count += 1
+        self.projectile_counts[slot] = count
+        
+        self.ticks[slot] = tick
+        self.newest_tick = tick
+    
+    def resolve_tick(self, tick):
+        """Clamp a requested tick to the range still held in the buffer"""
+        oldest = max(self.oldest_tick, self.newest_tick - self.size + 1,
+                     self.newest_tick - MAX_REWIND_TICKS)
+        return max(oldest, min(tick, self.newest_tick))
+    
+    def check_laser_collisions(self, tick, level, player_pos):
+        tick = self.resolve_tick(tick)
+        slot = tick % self.size
+        if self.ticks[slot] != tick:
+            return level.check_laser_collisions(player_pos)
+        
+        base = slot * MAX_LASERS
+        for i, laser in enumerate(level.laser_lines):
+            if laser.check_collision(player_pos, PLAYER_SIZE, self.laser_angles[base + i]):
+                return True
+        return False
+    
+    def check_projectile_collisions(self, tick, level, player_pos):
+        tick = self.resolve_tick(tick)
+        slot = tick % self.size
+        if self.ticks[slot] != tick:
+            return level.check_projectile_collisions(player_pos)
+        
+        px, py = player_pos
+        hit_distance_sq = (PROJECTILE_SIZE + PLAYER_SIZE) ** 2
+        base = slot * MAX_HISTORY_PROJECTILES * 2
+        for i in range(self.projectile_counts[slot]):
+            dx = self.projectile_pos[base + i * 2] - px
+            dy = self.projectile_pos[base + i * 2 + 1] - py
+            if dx * dx + dy * dy <= hit_distance_sq:
+                return True
+        return False
+
+class TickBudgetController:
+    """Tracks tick time against the budget and sheds work under load.
+
+    The degradation level is the number of DEGRADATION_STEPS currently
+    active: 1 halves the snapshot rate, 2 drops player trails, 3 sends
+    dead/finished players (spectators) a quarter of the snapshots, and 4
+    stops accepting new players. Levels change one step at a time, with
+    hysteresis so the controller doesn't flap.
+    """
+    def __init__(self, budget=TICK_BUDGET):
+        self.budget = budget
+        self.tick_time = 0.0  # Smoothed seconds of work per tick
+        self.last_tick_time = 0.0
+        self.overruns = 0
+        self.level = 0
+        self.pressure_ticks = 0
+        self.calm_ticks = 0
+        self.activations = {step: 0 for step in DEGRADATION_STEPS}
+    
+    def record(self, elapsed):
+        self.last_tick_time = elapsed
+        if elapsed > self.budget:
+            self.overruns += 1
+        self.tick_time += (elapsed - self.tick_time) * TICK_LOAD_SMOOTHING
+        
+        load = self.tick_time / self.budget
+        if load > DEGRADE_LOAD:
+            self.pressure_ticks += 1
+            self.calm_ticks = 0
+        elif load < RESTORE_LOAD:
+            self.calm_ticks += 1
+            self.pressure_ticks = 0
+        else:
+            self.pressure_ticks = 0
+            self.calm_ticks = 0
+        
+        if self.pressure_ticks >= DEGRADE_AFTER_TICKS and self.level < len(DEGRADATION_STEPS):
+            step = DEGRADATION_STEPS[self.level]
+            self.level += 1
+            self.activations[step] += 1
+            self.pressure_ticks = 0
+            print(f"Tick budget exceeded ({self.tick_time * 1000:.1f} ms), degrading: {step}")
+        elif self.calm_ticks >= RESTORE_AFTER_TICKS and self.level > 0:
+            self.level -= 1
+            self.calm_ticks = 0
+            print(f"Load dropped ({self.tick_time * 1000:.1f} ms), restoring: {DEGRADATION_STEPS[self.level]}")
+    
+    def is_active(self, step):
+        return DEGRADATION_STEPS.index(step) < self.level
+    
+    def should_send_snapshot(self, tick):
+        return not self.is_active('snapshot_rate') or tick % 2 == 0
+    
+    def should_update_spectators(self, tick):
+        return not self.is_active('spectators') or tick % 8 == 0
+    
+    def accepting_players(self):
+        return not self.is_active('admission')
+    
+    def metrics(self):
+        """Render controller state in Prometheus text format"""
+        lines = [
+            '# TYPE laser_game_tick_seconds gauge',
+            f'laser_game_tick_seconds {self.tick_time:.6f}',
+            '# TYPE laser_game_tick_budget_seconds gauge',
+            f'laser_game_tick_budget_seconds {self.budget:.6f}',
+            '# TYPE laser_game_tick_overruns_total counter',
+            f'laser_game_tick_overruns_total {self.overruns}',
+            '# TYPE laser_game_degradation_level gauge',
+            f'laser_game_degradation_level {self.level}',
+            '# TYPE laser_game_degradation_step_active gauge'
+        ]
+        for step in DEGRADATION_STEPS:
+            lines.append(f'laser_game_degradation_step_active{{step="{step}"}} {int(self.is_active(step))}')
+        lines.append('# TYPE laser_game_degradation_step_activations_total counter')
+        for step in DEGRADATION_STEPS:
+            lines.append(f'laser_game_degradation_step_activations_total{{step="{step}"}} {self.activations[step]}')
+        return '\n'.join(lines) + '\n'
+
 class GameManager:
     def __init__(self):
         self.players = {}
@@ -517,6 +706,14 @@ class GameManager:
         self.last_update = time.time()
         self.running = True
         
+        # Lag compensation
+        self.tick = 0
+        self.history = ObstacleHistory()
+        
+        # Per-worker load shedding
+        self.broadcast_count = 0
+        self.load_controller = TickBudgetController()
+        
         # Start game loop
         self.game_thread = threading.Thread(target=self.game_loop)
         self.game_thread.daemon = True
@@ -539,10 +736,14 @@ class GameManager:
             del self.players[session_id]
             print(f"Player {player_id} left (session: {session_id})")
     
-    def move_player(self, session_id, new_pos):
+    def move_player(self, session_id, new_pos, client_tick=None):
         if session_id in self.players:
             player = self.players[session_id]
             if player.alive and not player.finished and self.game_state == 'playing':
+                # Remember how far behind the server this client's view is
+                if isinstance(client_tick, int):
+                    player.view_lag = max(0, min(self.tick - client_tick, MAX_REWIND_TICKS))
+                
                 # Keep player in bounds
                 new_pos[0] = max(PLAYER_SIZE, min(WINDOW_WIDTH - PLAYER_SIZE, new_pos[0]))
                 new_pos[1] = max(PLAYER_SIZE, min(WINDOW_HEIGHT - PLAYER_SIZE, new_pos[1]))
@@ -556,6 +757,7 @@ class GameManager:
     def next_level(self):
         self.current_level += 1
         self.level = GameLevel(self.current_level)
+        self.history.reset(self.tick + 1)
         self.game_state = 'playing'
         self.round_winner = None
         
@@ -573,6 +775,7 @@ class GameManager:
     
     def game_loop(self):
         while self.running:
+            tick_start = time.perf_counter()  # Monotonic, for the tick budget
             current_time = time.time()
             dt = current_time - self.last_update
             self.last_update = current_time
@@ -580,17 +783,22 @@ class GameManager:
             if self.game_state == 'playing':
                 # Pass players to level update for player-triggered rotation and projectile targeting
                 self.level.update(self.players, dt)
+                self.tick += 1
+                self.history.record(self.tick, self.level)
                 
                 # Check for collisions and finish line
                 for player in self.players.values():
                     if player.alive and not player.finished:
+                        # Judge the player against the obstacles they were actually seeing
+                        seen_tick = self.tick - player.view_lag
+                        
                         # Check laser collisions
-                        if self.level.check_laser_collisions(player.pos):
+                        if self.history.check_laser_collisions(seen_tick, self.level, player.pos):
                             player.alive = False
                             print(f"Player {player.id} hit a laser!")
                         
                         # Check projectile collisions
-                        elif self.level.check_projectile_collisions(player.pos):
+                        elif self.history.check_projectile_collisions(seen_tick, self.level, player.pos):
                             player.alive = False
                             print(f"Player {player.id} hit a projectile!")
                         
@@ -618,18 +826,33 @@ class GameManager:
             # Broadcast game state to all clients
             self.broadcast_game_state()
             
-            time.sleep(1/60)  # 60 FPS
+            # Sleep only for what is left of the tick budget
+            elapsed = time.perf_counter() - tick_start
+            self.load_controller.record(elapsed)
+            time.sleep(max(0, TICK_BUDGET - elapsed))
     
     def broadcast_game_state(self):
+        controller = self.load_controller
+        self.broadcast_count += 1
+        if not controller.should_send_snapshot(self.broadcast_count):
+            return
+        
+        include_trail = not controller.is_active('trails')
         game_data = {
-            'players': {sid: player.to_dict() for sid, player in self.players.items()},
+            'players': {sid: player.to_dict(include_trail) for sid, player in self.players.items()},
             'level_data': self.level.to_dict(),
             'game_state': self.game_state,
             'winner': self.round_winner,
-            'current_level': self.current_level
+            'current_level': self.current_level,
+            'tick': self.tick
         }
         
-        socketio.emit('game_state', game_data)
+        if controller.should_update_spectators(self.broadcast_count):
+            socketio.emit('game_state', game_data)
+        else:
+            # Dead or finished players are only watching; skip them this time
+            spectators = [sid for sid, p in self.players.items() if not p.alive or p.finished]
+            socketio.emit('game_state', game_data, skip_sid=spectators)
     
     def get_game_state(self):
         return {
@@ -637,7 +860,8 @@ class GameManager:
             'level_data': self.level.to_dict(),
             'game_state': self.game_state,
             'winner': self.round_winner,
-            'current_level': self.current_level
+            'current_level': self.current_level,
+            'tick': self.tick
         }
 
 # Global game manager
@@ -647,8 +871,16 @@ game_manager = GameManager()
 def index():
     return render_template('index.html')
 
+@app.route('/metrics')
+def metrics():
+    return Response(game_manager.load_controller.metrics(), mimetype='text/plain')
+
 @socketio.on('connect')
 def handle_connect():
+    if not game_manager.load_controller.accepting_players():
+        print(f'Server overloaded, rejecting client: {request.sid}')
+        return False
+    
     print(f'Client connected: {request.sid}')
     player = game_manager.add_player(request.sid)
     
@@ -668,7 +900,7 @@ def handle_disconnect():
 
 @socketio.on('move_player')
 def handle_move_player(data):
-    game_manager.move_player(request.sid, data['pos'])
+    game_manager.move_player(request.sid, data['pos'], data.get('tick'))
 
 @socketio.on('start_game')
 def handle_start_game():